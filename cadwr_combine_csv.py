@@ -4,10 +4,18 @@ import logging
 import os
 import pprint
 
+import numpy as np
 import pandas as pd
 
 MODELS = ['DISALEXI', 'EEMETRIC', 'GEESEBAL', 'PTJPL', 'SIMS', 'SSEBOP', 'ENSEMBLE']
 
+# Water years start in October (i.e. water year 2004 is 2003-10-01 to 2004-09-30)
+WATER_YEAR_START_MONTH = 10
+# Growing season months (April through October)
+GROWING_SEASON_MONTHS = [4, 5, 6, 7, 8, 9, 10]
+# Period types in the summary cube (the "month" type is only used for the model spread)
+CUBE_PERIOD_TYPES = ['water_year', 'growing_season']
+
 
 def main(overwrite_flag=False):
 
@@ -16,6 +24,7 @@ def main(overwrite_flag=False):
         print(f'\n{export_name}')
 
         export_df_list = []
+        new_dates = set()
         for model in MODELS:
             model_ws = os.path.join(export_ws, model)
             if not os.path.isdir(model_ws):
@@ -36,23 +45,247 @@ def main(overwrite_flag=False):
             #     if len(pd.read_csv(csv_path)) != 514:
             #         print(csv_path)
 
-            model_df = pd.concat(map(pd.read_csv, csv_list), ignore_index=True)
-            model_df.sort_values(['Basin_Subb', 'Date'], inplace=True)
+            # Only read the CSV files for dates that are not already in the
+            #   combined model CSV, or that have been rewritten since it was built
+            model_csv = os.path.join(export_ws, f'{export_name}_{model.lower()}.csv')
+            if os.path.isfile(model_csv) and not overwrite_flag:
+                prev_df = pd.read_csv(model_csv)
+                prev_dates = set(prev_df['Date'])
+                model_mtime = os.path.getmtime(model_csv)
+                csv_list = [
+                    csv_path for csv_path in csv_list
+                    if (csv_date(csv_path) not in prev_dates)
+                        or (os.path.getmtime(csv_path) > model_mtime)
+                ]
+                print(f'New files: {len(csv_list)}')
+            else:
+                prev_df = None
 
-            model_df['ET_MM'] = model_df['ET']
-            model_df['ET_INCH'] = round(model_df['ET'] / 25.4, 6)
-            del model_df['ET']
+            if csv_list:
+                model_df = pd.concat(map(pd.read_csv, csv_list), ignore_index=True)
+                model_df['ET_MM'] = model_df['ET']
+                model_df['ET_INCH'] = round(model_df['ET'] / 25.4, 6)
+                del model_df['ET']
+                new_dates.update(model_df['Date'])
+                if prev_df is not None:
+                    prev_df = prev_df[~prev_df['Date'].isin(model_df['Date'])]
+                    model_df = pd.concat([prev_df, model_df], ignore_index=True)
+            else:
+                model_df = prev_df
+
+            model_df.sort_values(['Basin_Subb', 'Date'], inplace=True)
             print(f'Rows: {len(model_df.index)}')
 
             export_df_list.append(model_df)
             # print(model_df)
 
-            model_df.to_csv(os.path.join(export_ws, f'{export_name}_{model.lower()}.csv'), index=False)
+            model_df.to_csv(model_csv, index=False)
+
+            write_matrix(model_df, os.path.join(export_ws, f'{export_name}_{model.lower()}_matrix.npz'))
 
         export_df = pd.concat(export_df_list, ignore_index=True)
         export_df.sort_values(['Basin_Subb', 'Model', 'Date'], inplace=True)
         export_df.to_csv(os.path.join(export_ws, f'{export_name}_all_models.csv'), index=False)
 
+        # Only the periods containing new dates need to be recomputed
+        print('\nBuilding summary cube')
+        update_cube(
+            export_df,
+            cube_path=os.path.join(export_ws, f'{export_name}_cube.csv'),
+            spread_path=os.path.join(export_ws, f'{export_name}_model_spread.csv'),
+            new_dates=None if overwrite_flag else new_dates,
+        )
+
+
+def csv_date(csv_path):
+    """Return the ISO date string from a per-date CSV file name (..._YYYYMMDD.csv)"""
+    date_str = os.path.splitext(os.path.basename(csv_path))[0].split('_')[-1]
+    return datetime.strptime(date_str, '%Y%m%d').strftime('%Y-%m-%d')
+
+
+def period_series(date_series, period_type):
+    """Return the summary period for each date as a string
+
+    Dates that are not in a period (i.e. outside of the growing season) are NaN.
+
+    """
+    if period_type == 'month':
+        return date_series.astype(str)
+
+    date_dt = pd.to_datetime(date_series)
+    if period_type == 'water_year':
+        return (date_dt.dt.year + (date_dt.dt.month >= WATER_YEAR_START_MONTH)).astype(str)
+    elif period_type == 'growing_season':
+        return date_dt.dt.year.astype(str).where(date_dt.dt.month.isin(GROWING_SEASON_MONTHS))
+    else:
+        raise ValueError(f'unsupported period type: {period_type}')
+
+
+def build_cube(export_df, periods=None):
+    """Compute the water year and growing season ET totals for each basin and model
+
+    Parameters
+    ----------
+    export_df : pd.DataFrame
+        Combined monthly table with "Basin_Subb", "Model", "Date", and "ET_MM" columns.
+    periods : dict, optional
+        Set of periods to compute for each period type.  All periods will be
+        computed if not set.
+
+    Returns
+    -------
+    pd.DataFrame
+
+    """
+    cube_df_list = []
+    for period_type in CUBE_PERIOD_TYPES:
+        period = period_series(export_df['Date'], period_type)
+        if periods is not None:
+            period = period.where(period.isin(periods.get(period_type, set())))
+        period_df = export_df.assign(Period=period).dropna(subset=['Period'])
+
+        cube_df = (
+            period_df.groupby(['Basin_Subb', 'Period', 'Model'])['ET_MM']
+            .agg(['sum', 'count'])
+            .reset_index()
+            .rename(columns={'sum': 'ET_MM', 'count': 'Months'})
+        )
+        # Don't report a zero total for periods without any ET values
+        cube_df['ET_MM'] = cube_df['ET_MM'].where(cube_df['Months'] > 0).round(4)
+        cube_df.insert(loc=4, column='ET_INCH', value=round(cube_df['ET_MM'] / 25.4, 6))
+        cube_df.insert(loc=1, column='Period_Type', value=period_type)
+        cube_df_list.append(cube_df)
+
+    return pd.concat(cube_df_list, ignore_index=True)
+
+
+def build_spread(export_df, cube_df, periods=None):
+    """Compute the cross model spread relative to the ENSEMBLE for each basin and period
+
+    The MIN, MAX, and MAD (mean absolute difference from the ensemble) are
+    computed from the individual models only (i.e. excluding the ENSEMBLE).
+    Model totals that are built from a different number of months than the
+    ENSEMBLE total (or the most complete model if there is no ENSEMBLE) are
+    not included, and "Months" is the number of months in the compared totals.
+
+    """
+    month_period = period_series(export_df['Date'], 'month')
+    if periods is not None:
+        month_period = month_period.where(month_period.isin(periods.get('month', set())))
+    month_df = (
+        export_df.assign(
+            Period_Type='month', Period=month_period,
+            Months=export_df['ET_MM'].notna().astype(int),
+        )
+        .dropna(subset=['Period'])
+    )
+    columns = ['Basin_Subb', 'Period_Type', 'Period', 'Model', 'ET_MM', 'Months']
+    period_df = pd.concat([month_df[columns], cube_df[columns]], ignore_index=True)
+
+    # Wide tables with a column for each model
+    period_df = period_df.set_index(['Basin_Subb', 'Period_Type', 'Period', 'Model'])
+    model_df = period_df['ET_MM'].unstack('Model')
+    months_df = period_df['Months'].unstack('Model')
+    if 'ENSEMBLE' in model_df.columns:
+        ensemble = model_df.pop('ENSEMBLE')
+        months = months_df.pop('ENSEMBLE').fillna(months_df.max(axis=1))
+    else:
+        ensemble = pd.Series(np.nan, index=model_df.index)
+        months = months_df.max(axis=1)
+    model_df = model_df.where(months_df.eq(months, axis=0))
+
+    spread_df = pd.DataFrame({
+        'ENSEMBLE_MM': ensemble,
+        'MIN_MM': model_df.min(axis=1),
+        'MAX_MM': model_df.max(axis=1),
+        'MAD_MM': model_df.sub(ensemble, axis=0).abs().mean(axis=1),
+        'Models': model_df.count(axis=1),
+        'Months': months.astype(int),
+    })
+    spread_df = spread_df.round(4).reset_index()
+
+    return spread_df
+
+
+def update_cube(export_df, cube_path, spread_path, new_dates=None):
+    """Build or incrementally update the summary cube and model spread tables
+
+    Parameters
+    ----------
+    export_df : pd.DataFrame
+        Combined monthly table for all models.
+    cube_path : str
+    spread_path : str
+    new_dates : set, optional
+        Dates (YYYY-MM-DD) that were added or changed since the tables were
+        last written.  If not set, or if either table doesn't exist yet,
+        the tables will be rebuilt from scratch.
+
+    """
+    if (new_dates is None) or not os.path.isfile(cube_path) or not os.path.isfile(spread_path):
+        cube_df = build_cube(export_df)
+        spread_df = build_spread(export_df, cube_df)
+    else:
+        new_dates = pd.Series(sorted(new_dates), dtype=str)
+        periods = {
+            period_type: set(period_series(new_dates, period_type).dropna())
+            for period_type in CUBE_PERIOD_TYPES + ['month']
+        }
+        print('Updated periods: ' + ', '.join(
+            f'{period_type} ({len(period_set)})' for period_type, period_set in periods.items()
+        ))
+
+        new_cube_df = build_cube(export_df, periods)
+        new_spread_df = build_spread(export_df, new_cube_df, periods)
+
+        # Replace the rows for the updated periods in the existing tables
+        period_keys = {
+            f'{period_type}_{period}'
+            for period_type, period_set in periods.items()
+            for period in period_set
+        }
+        cube_df = pd.read_csv(cube_path, dtype={'Basin_Subb': str, 'Period': str})
+        cube_df = pd.concat(
+            [cube_df[~(cube_df['Period_Type'] + '_' + cube_df['Period']).isin(period_keys)],
+             new_cube_df],
+            ignore_index=True,
+        )
+        spread_df = pd.read_csv(spread_path, dtype={'Basin_Subb': str, 'Period': str})
+        spread_df = pd.concat(
+            [spread_df[~(spread_df['Period_Type'] + '_' + spread_df['Period']).isin(period_keys)],
+             new_spread_df],
+            ignore_index=True,
+        )
+
+    cube_df.sort_values(['Basin_Subb', 'Period_Type', 'Period', 'Model'], inplace=True)
+    cube_df.to_csv(cube_path, index=False)
+    print(f'Cube rows: {len(cube_df.index)}')
+
+    spread_df.sort_values(['Basin_Subb', 'Period_Type', 'Period'], inplace=True)
+    spread_df.to_csv(spread_path, index=False)
+    print(f'Spread rows: {len(spread_df.index)}')
+
+
+def write_matrix(model_df, npz_path):
+    """Write a compact basin x month matrix of the model ET and pixel counts
+
+    The NPZ file contains the "basin" and "date" labels for the rows and
+    columns of the float32 "et_mm" and int32 "pixel_count" arrays.
+
+    """
+    et_df = model_df.pivot(index='Basin_Subb', columns='Date', values='ET_MM')
+    count_df = (
+        model_df.pivot(index='Basin_Subb', columns='Date', values='Pixel_Count')
+        .reindex(index=et_df.index, columns=et_df.columns)
+    )
+    np.savez_compressed(
+        npz_path,
+        basin=et_df.index.to_numpy(dtype=str),
+        date=pd.to_datetime(et_df.columns).values.astype('datetime64[D]'),
+        et_mm=et_df.values.astype(np.float32),
+        pixel_count=count_df.fillna(0).values.astype(np.int32),
+    )
+
 
 def arg_parse():
     """"""
@@ -9,6 +9,8 @@ import ee
 import pandas as pd
 import openet.core
 
+import cadwr_plan
+
 # logging.getLogger('earthengine-api').setLevel(logging.INFO)
 logging.getLogger('googleapiclient').setLevel(logging.INFO)
 # logging.getLogger('requests').setLevel(logging.INFO)
@@ -29,6 +31,9 @@ def main(
         overwrite_flag=False,
         reverse_flag=False,
         processes=20,
+        chunksize=None,
+        plan_flag=False,
+        prep_flag=True,
 ):
     """Extract California/CIMIS OpenET monthly aggregations for agricultural lands
 
@@ -49,6 +54,14 @@ def main(
         If True, dates will be processed in reverse order (the default is False).
     processes : int, optional
         The number of multiprocessing workers.
+    chunksize : int, optional
+        The multiprocessing pool chunk size (the default is None).
+    plan_flag : bool, optional
+        If True, print the estimated request count, pixel load and runtime
+        and return without extracting any data (the default is False).
+    prep_flag : bool, optional
+        If True, use the prepared (clipped and simplified) feature geometries
+        if they have been uploaded and validated (the default is True).
 
     """
     # export_name = 'ag_lands'
@@ -92,6 +105,31 @@ def main(
     if not os.path.isdir(export_ws):
         os.makedirs(export_ws)
 
+    feature_ids_path = os.path.join(export_ws, 'feature_ids.json')
+
+    if plan_flag:
+        # Only initialize EE if a collection listing hasn't been cached yet
+        if not all(
+            os.path.isfile(os.path.join(export_ws, f'{model_name.lower()}_image_ids.json'))
+            for model_name in models
+        ) or not os.path.isfile(feature_ids_path):
+            ee_initializer(project_id=project_id, opt_url='https://earthengine-highvolume.googleapis.com')
+        cadwr_plan.plan(
+            export_ws=export_ws,
+            export_name=export_name,
+            model_coll_ids=model_coll_ids,
+            models=models,
+            feature_ids=cadwr_plan.collection_feature_ids(
+                feature_coll_id, feature_id_property, feature_ids_path
+            ),
+            start_date=start_date,
+            end_date=end_date,
+            overwrite_flag=overwrite_flag,
+            processes=processes,
+            chunksize=chunksize,
+        )
+        return
+
     ee_initializer(project_id=project_id, opt_url='https://earthengine-highvolume.googleapis.com')
 
     # # CIMIS Albers Equal Area Projection
@@ -117,11 +155,21 @@ def main(
     # # export_extent = [-124.5, 32.4, -114.0, 42.1]
     # # cellsize = 0.000269494585235856472
 
+    # Use the clipped and simplified geometries if they have been uploaded
+    #   and their pixel counts have been validated (see cadwr_prep_geometry.py)
+    prep_info = ee.data.getInfo(f'{feature_coll_id}_prep') if prep_flag else None
+    if prep_info and prep_info.get('properties', {}).get('pixel_count_validated'):
+        feature_coll_id = f'{feature_coll_id}_prep'
+        logging.info(f'Using prepared geometries: {feature_coll_id}')
+    elif prep_info:
+        logging.info('Prepared geometries have not been validated, using full resolution geometries')
+
     # Read the feature properties
     feature_info = {
         ftr['properties'][feature_id_property]: ftr['properties']
         for ftr in ee.FeatureCollection(feature_coll_id).getInfo()['features']
     }
+    cadwr_plan.write_feature_ids(feature_ids_path, feature_coll_id, feature_info.keys())
 
     # Process by model and date
     for model_name in models:
@@ -135,16 +183,13 @@ def main(
         model_coll_id = model_coll_ids[model_name]
         logging.debug(f'  {model_coll_id}')
 
-        image_id_list = (
-            ee.ImageCollection(model_coll_id)
-            .filterDate(start_date, end_date)
-            .aggregate_array('system:index')
-            .getInfo()
+        # Refresh the cached collection listing so that it is current for --plan
+        image_id_list = cadwr_plan.collection_image_ids(
+            model_coll_id,
+            os.path.join(export_ws, f'{model_name.lower()}_image_ids.json'),
+            refresh_flag=True,
         )
-        date_list = list(set(
-            datetime.strptime(image_id.split('_')[-2], '%Y%m%d')
-            for image_id in image_id_list
-        ))
+        date_list = cadwr_plan.image_dates(image_id_list, start_date, end_date)
 
         model_export_ws = os.path.join(export_ws, model_name)
         if not os.path.isdir(model_export_ws):
@@ -180,7 +225,7 @@ def main(
                     initializer=ee_initializer,
                     initargs=(project_id, 'https://earthengine-highvolume.googleapis.com')
             ) as p:
-                output = p.starmap(feature_extract, input_list)
+                output = p.starmap(feature_extract, input_list, chunksize=chunksize)
 
             logging.debug('  building dataframe')
             output_df = pd.DataFrame(output)
@@ -301,6 +346,15 @@ def arg_parse():
     parser.add_argument(
         '--mp', type=int, default=20,
         help='Number of multiprocessing workers')
+    parser.add_argument(
+        '--chunksize', type=int, default=None,
+        help='Multiprocessing pool chunk size')
+    parser.add_argument(
+        '--plan', default=False, action='store_true',
+        help='Estimate the request count, pixel load and runtime without extracting')
+    parser.add_argument(
+        '--no-prep', default=True, action='store_false', dest='prep',
+        help='Use the full resolution feature geometries instead of the prepared asset')
     parser.add_argument(
         '--project', default='openet',
         help='Google cloud project ID to use for GEE authentication')
@@ -329,4 +383,7 @@ if __name__ == '__main__':
         overwrite_flag = args.overwrite,
         reverse_flag=args.reverse,
         processes=args.mp,
+        chunksize=args.chunksize,
+        plan_flag=args.plan,
+        prep_flag=args.prep,
     )
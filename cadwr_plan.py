@@ -0,0 +1,417 @@
+import heapq
+import json
+from datetime import datetime
+import logging
+import math
+import os
+
+import pandas as pd
+
+# Rough cost model for a single feature/month reduceRegion request
+# These are only used for planning and can be overridden when calling plan()
+REQUEST_SECONDS = 2.0
+PIXEL_SECONDS = 2.0 / 1000000
+# Pixel count assumed for features without any historical CSV values
+#   (roughly the mean all lands basin pixel count)
+DEFAULT_PIXEL_COUNT = 330000
+# Overhead for starting a new worker pool (and initializing EE) for each month
+POOL_SECONDS = 10.0
+# Upper limit on the recommended number of workers for the high volume endpoint
+MAX_WORKERS = 40
+# Recommend the fewest workers that are within this fraction of the fastest runtime
+RUNTIME_TOLERANCE = 0.05
+
+
+def collection_image_ids(model_coll_id, cache_path, refresh_flag=False):
+    """Return the image IDs in a collection, using the local listing cache if possible
+
+    Parameters
+    ----------
+    model_coll_id : str
+        Earth Engine image collection ID.
+    cache_path : str
+        JSON file path for the cached collection listing.
+    refresh_flag : bool, optional
+        If True, always query the collection and update the cache.
+        Earth Engine must already be initialized if the listing is queried.
+
+    Returns
+    -------
+    list of str
+
+    """
+    if not refresh_flag and os.path.isfile(cache_path):
+        logging.debug(f'  reading cached image list: {cache_path}')
+        with open(cache_path, 'r') as f:
+            return json.load(f)['image_ids']
+
+    # Only import EE if the collection actually needs to be queried
+    import ee
+    logging.debug(f'  requesting image list: {model_coll_id}')
+    image_id_list = (
+        ee.ImageCollection(model_coll_id)
+        .aggregate_array('system:index')
+        .getInfo()
+    )
+
+    _write_listing(cache_path, model_coll_id, 'image_ids', sorted(image_id_list))
+
+    return image_id_list
+
+
+def collection_feature_ids(feature_coll_id, feature_id_property, cache_path, refresh_flag=False):
+    """Return the feature IDs in a collection, using the local listing cache if possible
+
+    The IDs are returned in collection order, which is the order the
+    extraction tools submit the feature requests in.
+
+    Parameters
+    ----------
+    feature_coll_id : str
+        Earth Engine feature collection ID.
+    feature_id_property : str
+        Feature property used to uniquely identify each feature.
+    cache_path : str
+        JSON file path for the cached collection listing.
+    refresh_flag : bool, optional
+        If True, always query the collection and update the cache.
+        Earth Engine must already be initialized if the listing is queried.
+
+    Returns
+    -------
+    list of str
+
+    """
+    if not refresh_flag and os.path.isfile(cache_path):
+        logging.debug(f'  reading cached feature list: {cache_path}')
+        with open(cache_path, 'r') as f:
+            return json.load(f)['feature_ids']
+
+    import ee
+    logging.debug(f'  requesting feature list: {feature_coll_id}')
+    feature_id_list = (
+        ee.FeatureCollection(feature_coll_id)
+        .aggregate_array(feature_id_property)
+        .getInfo()
+    )
+    write_feature_ids(cache_path, feature_coll_id, feature_id_list)
+
+    return feature_id_list
+
+
+def write_feature_ids(cache_path, feature_coll_id, feature_id_list):
+    """Update the cached feature ID listing (in collection order)"""
+    _write_listing(cache_path, feature_coll_id, 'feature_ids', list(feature_id_list))
+
+
+def image_dates(image_id_list, start_date=None, end_date=None):
+    """Return the sorted unique image dates in the (inclusive/exclusive) date range
+
+    The date is parsed from the second to last part of the image ID
+    (i.e. "..._YYYYMMDD_YYYYMMDD") to match the extraction tools.
+
+    """
+    start_dt = _to_datetime(start_date)
+    end_dt = _to_datetime(end_date)
+    date_list = set(
+        datetime.strptime(image_id.split('_')[-2], '%Y%m%d')
+        for image_id in image_id_list
+    )
+    return sorted(
+        image_dt for image_dt in date_list
+        if (start_dt is None or image_dt >= start_dt)
+        and (end_dt is None or image_dt < end_dt)
+    )
+
+
+def pixel_counts(csv_ws):
+    """Return the median historical pixel count for each feature
+
+    Parameters
+    ----------
+    csv_ws : str
+        Folder of existing per-date extraction CSV files.
+        Files with either the "Pixel_Count" or "PIXEL_COUNT" column are supported.
+
+    Returns
+    -------
+    pd.Series indexed by feature ID (empty if there are no CSV files)
+
+    """
+    if not os.path.isdir(csv_ws):
+        return pd.Series(dtype='float64')
+
+    count_df_list = []
+    for item in sorted(os.listdir(csv_ws)):
+        if not item.endswith('.csv'):
+            continue
+        csv_df = pd.read_csv(
+            os.path.join(csv_ws, item),
+            usecols=lambda c: c in ['Basin_Subb', 'Pixel_Count', 'PIXEL_COUNT'],
+            dtype={'Basin_Subb': str},
+        )
+        csv_df.rename(columns={'Pixel_Count': 'PIXEL_COUNT'}, inplace=True)
+        if 'PIXEL_COUNT' not in csv_df.columns:
+            continue
+        count_df_list.append(csv_df)
+
+    if not count_df_list:
+        return pd.Series(dtype='float64')
+
+    count_df = pd.concat(count_df_list, ignore_index=True)
+    return count_df.groupby('Basin_Subb')['PIXEL_COUNT'].median()
+
+
+def request_seconds(pixel_count, request_seconds=REQUEST_SECONDS, pixel_seconds=PIXEL_SECONDS):
+    """Estimated runtime of a single reduceRegion request"""
+    return request_seconds + pixel_seconds * pixel_count
+
+
+def pool_chunksize(task_count, workers, chunksize=None):
+    """Chunk size that multiprocessing.Pool.starmap will use
+
+    If the chunk size is not set, this matches the Pool default of
+    roughly 4 chunks per worker.
+
+    """
+    if chunksize:
+        return chunksize
+    return max(1, math.ceil(task_count / (4 * workers)))
+
+
+def month_seconds(cost_list, workers, chunksize=None, pool_seconds=POOL_SECONDS):
+    """Estimated wall time for processing all features for one month
+
+    The chunks of consecutive requests are handed out in order to whichever
+    worker is free first (like multiprocessing.Pool), so the estimate
+    accounts for large basins that end up in the same chunk.
+
+    Parameters
+    ----------
+    cost_list : list of float
+        Estimated seconds for each feature request, in submission order.
+    workers : int
+    chunksize : int, optional
+        Pool chunk size (the Pool default is used if not set).
+    pool_seconds : float, optional
+        Overhead for starting the worker pool.
+
+    """
+    if not cost_list:
+        return 0
+    chunksize = pool_chunksize(len(cost_list), workers, chunksize)
+
+    worker_times = [0.0] * workers
+    for i in range(0, len(cost_list), chunksize):
+        heapq.heappush(
+            worker_times,
+            heapq.heappop(worker_times) + sum(cost_list[i:i + chunksize])
+        )
+
+    return pool_seconds + max(worker_times)
+
+
+def recommend(cost_list, processes, chunksize=None, max_workers=MAX_WORKERS,
+              tolerance=RUNTIME_TOLERANCE):
+    """Recommend a worker count and chunk size for one month of requests
+
+    The recommendation is the fewest workers (and then the smallest chunk
+    size) whose estimated runtime is within the tolerance of the fastest
+    option, since extra workers only add quota pressure.  The current
+    setup is returned if the recommendation would not be faster.
+
+    Parameters
+    ----------
+    cost_list : list of float
+        Estimated seconds for each feature request in a single month.
+    processes : int
+        The current number of workers.
+    chunksize : int, optional
+        The current chunk size (the Pool default is used if not set).
+    max_workers : int, optional
+    tolerance : float, optional
+
+    Returns
+    -------
+    tuple of the worker count, chunk size, and estimated month seconds
+
+    """
+    current = (
+        processes,
+        pool_chunksize(len(cost_list), processes, chunksize),
+        month_seconds(cost_list, processes, chunksize),
+    )
+    if not cost_list:
+        return current
+
+    options = [
+        (workers, c, month_seconds(cost_list, workers, c))
+        for workers in range(1, max_workers + 1)
+        for c in range(1, pool_chunksize(len(cost_list), workers) + 1)
+    ]
+    fastest = min(seconds for workers, c, seconds in options)
+    recommended = min(
+        option for option in options if option[2] <= fastest * (1 + tolerance)
+    )
+
+    if recommended[2] >= current[2]:
+        return current
+    return recommended
+
+
+def plan(
+        export_ws,
+        export_name,
+        model_coll_ids,
+        models,
+        feature_ids,
+        start_date=None,
+        end_date=None,
+        overwrite_flag=False,
+        processes=20,
+        chunksize=None,
+        request_secs=REQUEST_SECONDS,
+        pixel_secs=PIXEL_SECONDS,
+):
+    """Print the estimated request count, pixel load, and runtime of an extraction
+
+    Parameters
+    ----------
+    export_ws : str
+        Extraction output folder (containing the model sub-folders).
+    export_name : str
+    model_coll_ids : dict
+        Image collection ID for each model.
+    models : list
+    feature_ids : list, optional
+        Feature IDs that will be extracted (in submission order).
+        If not set, the feature IDs in the historical CSV files will be used.
+    start_date : str, optional
+    end_date : str, optional
+    overwrite_flag : bool, optional
+        If False, months with existing CSV files will be skipped.
+    processes : int, optional
+        The number of multiprocessing workers the runtime is estimated for.
+    chunksize : int, optional
+        The multiprocessing pool chunk size the runtime is estimated for
+        (the Pool default is used if not set).
+    request_secs : float, optional
+        Fixed cost (in seconds) of each reduceRegion request.
+    pixel_secs : float, optional
+        Additional cost (in seconds) for each pixel in the request.
+
+    Returns
+    -------
+    pd.DataFrame of the per model summary
+
+    """
+    # Historical pixel counts shouldn't really change between models,
+    #   so use the pooled counts for models that don't have any CSV files yet
+    model_counts = {
+        model_name: pixel_counts(os.path.join(export_ws, model_name))
+        for model_name in models
+    }
+    pooled_counts = pd.concat(
+        [c for c in model_counts.values() if not c.empty] or [pd.Series(dtype='float64')]
+    )
+    pooled_counts = pooled_counts.groupby(level=0).median()
+
+    if not feature_ids:
+        feature_ids = sorted(pooled_counts.index)
+    if not feature_ids:
+        raise ValueError('feature IDs must be set if there are no existing CSV files')
+
+    summary_list = []
+    for model_name in models:
+        image_id_list = collection_image_ids(
+            model_coll_ids[model_name],
+            os.path.join(export_ws, f'{model_name.lower()}_image_ids.json'),
+        )
+        date_list = image_dates(image_id_list, start_date, end_date)
+
+        model_export_ws = os.path.join(export_ws, model_name)
+        target_list = [
+            image_date for image_date in date_list
+            if overwrite_flag or not os.path.exists(os.path.join(
+                model_export_ws,
+                f'{export_name}_{model_name.lower()}_{image_date.strftime("%Y%m%d")}.csv'
+            ))
+        ]
+
+        # Features without any history are assumed to be average sized
+        counts = model_counts[model_name] if not model_counts[model_name].empty else pooled_counts
+        counts = counts.reindex(feature_ids)
+        if counts.notna().any():
+            counts = counts.fillna(counts.mean())
+        else:
+            logging.info(f'  {model_name} - no pixel count history, '
+                         f'assuming {DEFAULT_PIXEL_COUNT} pixels per feature')
+            counts = counts.fillna(DEFAULT_PIXEL_COUNT)
+        cost_list = [
+            request_seconds(c, request_secs, pixel_secs) for c in counts.values
+        ]
+
+        summary_list.append({
+            'MODEL': model_name,
+            'MONTHS': len(date_list),
+            'PENDING': len(target_list),
+            'FIRST': target_list[0].strftime('%Y-%m-%d') if target_list else '',
+            'LAST': target_list[-1].strftime('%Y-%m-%d') if target_list else '',
+            'REQUESTS': len(target_list) * len(feature_ids),
+            'PIXELS': int(len(target_list) * counts.sum()),
+            'HOURS': len(target_list) * month_seconds(cost_list, processes, chunksize) / 3600,
+            'COST_LIST': cost_list,
+        })
+
+    # Each worker pool only handles a single model and month, so base the
+    #   recommendation on the month costs for the model with the most pending months
+    if summary_list:
+        cost_list = max(summary_list, key=lambda x: x['PENDING'])['COST_LIST']
+    else:
+        cost_list = []
+    current_chunksize = pool_chunksize(len(feature_ids), processes, chunksize)
+    workers, rec_chunksize, _ = recommend(cost_list, processes, chunksize)
+    for summary in summary_list:
+        summary['HOURS_RECOMMENDED'] = (
+            summary['PENDING']
+            * month_seconds(summary.pop('COST_LIST'), workers, rec_chunksize)
+            / 3600
+        )
+
+    summary_df = pd.DataFrame(summary_list)
+    print(f'\nPlan: {export_name}')
+    print(f'Features: {len(feature_ids)}')
+    print(summary_df.to_string(index=False, float_format=lambda x: f'{x:.2f}'))
+    print(f'\nTotal requests: {summary_df["REQUESTS"].sum()}')
+    print(f'Total pixels:   {summary_df["PIXELS"].sum()}')
+    print(f'Runtime ({processes} workers, chunk size {current_chunksize}): '
+          f'{summary_df["HOURS"].sum():.2f} hours')
+    if (workers, rec_chunksize) == (processes, current_chunksize):
+        print('Recommended: keep the current workers and chunk size')
+    else:
+        print(f'Recommended workers:    {workers}')
+        print(f'Recommended chunk size: {rec_chunksize}')
+        print(f'Runtime ({workers} workers, chunk size {rec_chunksize}): '
+              f'{summary_df["HOURS_RECOMMENDED"].sum():.2f} hours')
+
+    return summary_df
+
+
+def _write_listing(cache_path, coll_id, key, values):
+    """Write a cached collection listing"""
+    with open(cache_path, 'w') as f:
+        json.dump(
+            {
+                'collection': coll_id,
+                'updated': datetime.today().strftime('%Y-%m-%dT%H:%M:%S'),
+                key: values,
+            },
+            f, indent=1,
+        )
+
+
+def _to_datetime(input_date):
+    """Convert a date string (or datetime) to a datetime"""
+    if input_date is None or isinstance(input_date, datetime):
+        return input_date
+    return datetime.strptime(str(input_date)[:10], '%Y-%m-%d')
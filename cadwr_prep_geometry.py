@@ -0,0 +1,345 @@
+import argparse
+from datetime import datetime
+import json
+import logging
+import multiprocessing
+import os
+
+import ee
+import pandas as pd
+
+logging.getLogger('googleapiclient').setLevel(logging.INFO)
+logging.getLogger('urllib3').setLevel(logging.INFO)
+
+FEATURE_COLL_ID = 'projects/ee-cgmorton/assets/ca_gw_basins'
+FEATURE_ID_PROPERTY = 'Basin_Subb'
+PROJECT_ID = 'openet'
+# Simplification tolerance in meters, well below the 30m CIMIS cellsize
+TOLERANCE = 3
+
+
+def main(
+        lands='all_lands',
+        model_name='ENSEMBLE',
+        tolerance=TOLERANCE,
+        project_id=PROJECT_ID,
+        overwrite_flag=False,
+        validate_flag=False,
+        processes=20,
+):
+    """Clip, simplify, and cache the groundwater basin geometries on the CIMIS grid
+
+    The prepared geometries are checked against the per-basin pixel counts
+    in an existing extraction CSV before they are uploaded as the
+    "<feature collection>_prep" asset.  Since the table export re-encodes
+    the geometries, the uploaded asset must then be checked again with the
+    validate flag (after the export task finishes).  The extraction tools
+    only use the asset once this check has passed and been recorded in the
+    "pixel_count_validated" asset property.
+
+    Parameters
+    ----------
+    lands : {'all_lands', 'ag_lands'}
+        Extraction outputs to validate the pixel counts against.
+    model_name : str, optional
+        Model of the extraction outputs to validate the pixel counts against.
+        The last date with an existing CSV file will be used.
+    tolerance : float, optional
+        Simplification tolerance (in meters).
+    project_id : str, optional
+        Google cloud project ID to use for GEE authentication.
+    overwrite_flag : bool, optional
+        If True, rebuild the cached geometries and replace the asset.
+    validate_flag : bool, optional
+        If True, validate the pixel counts of the uploaded asset and mark it
+        as validated if they all match (the default is False).
+    processes : int, optional
+        The number of multiprocessing workers.
+
+    Returns
+    -------
+    bool : True if the pixel counts matched
+
+    """
+    if lands == 'all_lands':
+        export_ws = os.path.join(os.getcwd(), 'csv_basins_gw_basin_all_lands')
+        mask_flag = False
+    elif lands == 'ag_lands':
+        export_ws = os.path.join(os.getcwd(), 'csv_gw_basin_ag_lands')
+        mask_flag = True
+    else:
+        raise ValueError(f'unsupported lands parameter: {lands}')
+
+    model_coll_id = f'projects/openet/assets/{model_name.lower()}/california/cimis/monthly/v2_1'
+    et_band = 'et_ensemble_mad' if model_name == 'ENSEMBLE' else 'et'
+
+    prep_coll_id = f'{FEATURE_COLL_ID}_prep'
+    cache_path = os.path.join(
+        os.getcwd(), 'geometry', f'{FEATURE_COLL_ID.split("/")[-1]}_prep_{tolerance}m.geojson'
+    )
+    if not os.path.isdir(os.path.dirname(cache_path)):
+        os.makedirs(os.path.dirname(cache_path))
+
+    # Read the reference pixel counts first so a missing CSV folder fails early
+    csv_path, image_date, csv_counts = reference_counts(export_ws, model_name)
+
+    ee_initializer(project_id=project_id)
+
+    if validate_flag:
+        # Check the uploaded asset itself, reading each geometry from the
+        #   collection the same way the extraction tools do
+        if not ee.data.getInfo(prep_coll_id):
+            raise ValueError(f'asset does not exist, run without --validate first: {prep_coll_id}')
+        print(f'Validating asset pixel counts: {prep_coll_id}')
+        print(f'  {csv_path}')
+        ftr_ids = (
+            ee.FeatureCollection(prep_coll_id)
+            .aggregate_array(FEATURE_ID_PROPERTY)
+            .getInfo()
+        )
+        input_list = [
+            [image_date, model_coll_id, et_band, ftr_id, prep_coll_id, None, mask_flag]
+            for ftr_id in ftr_ids
+        ]
+        if not check_counts(ftr_ids, run_pixel_counts(input_list, project_id, processes), csv_counts):
+            print('\nAsset not marked as validated, the extraction tools will not use it')
+            return False
+
+        ee.data.setAssetProperties(prep_coll_id, {
+            'pixel_count_validated': datetime.today().strftime('%Y-%m-%d'),
+            'pixel_count_reference': os.path.basename(csv_path),
+            'tolerance': tolerance,
+        })
+        print(f'\nAsset marked as validated: {prep_coll_id}')
+        return True
+
+    export_crs, export_extent, export_geo = cimis_grid()
+
+    if os.path.isfile(cache_path) and not overwrite_flag:
+        print(f'Reading cached geometries: {cache_path}')
+        with open(cache_path, 'r') as f:
+            prep_info = json.load(f)
+    else:
+        print('Clipping and simplifying geometries')
+        extent_geom = ee.Geometry.Rectangle(export_extent, proj=export_crs, geodesic=False)
+
+        def prep_feature(ftr):
+            geom = (
+                ftr.geometry()
+                .intersection(extent_geom, ee.ErrorMargin(1, 'meters'), proj=export_crs)
+                .simplify(ee.ErrorMargin(tolerance, 'meters'), proj=export_crs)
+            )
+            return ftr.setGeometry(geom)
+
+        prep_info = ee.FeatureCollection(FEATURE_COLL_ID).map(prep_feature).getInfo()
+        with open(cache_path, 'w') as f:
+            json.dump(prep_info, f)
+
+    vertex_count = sum(_vertex_count(ftr['geometry']['coordinates']) for ftr in prep_info['features'])
+    print(f'Features: {len(prep_info["features"])}')
+    print(f'Vertices: {vertex_count}')
+
+    # Check the pixel counts for the cached geometries before uploading
+    #   so that a bad tolerance is caught without waiting on an export
+    print(f'\nChecking cached geometry pixel counts: {csv_path}')
+    ftr_ids = [ftr['properties'][FEATURE_ID_PROPERTY] for ftr in prep_info['features']]
+    input_list = [
+        [image_date, model_coll_id, et_band, ftr_id, None, ftr['geometry'], mask_flag]
+        for ftr_id, ftr in zip(ftr_ids, prep_info['features'])
+    ]
+    if not check_counts(ftr_ids, run_pixel_counts(input_list, project_id, processes), csv_counts):
+        print('\nNot uploading, try a smaller tolerance')
+        return False
+
+    # Upload the prepared geometries once
+    if ee.data.getInfo(prep_coll_id):
+        if not overwrite_flag:
+            print(f'\nAsset already exists, skipping upload: {prep_coll_id}')
+            return True
+        logging.info(f'Removing existing asset: {prep_coll_id}')
+        ee.data.deleteAsset(prep_coll_id)
+
+    print(f'\nUploading: {prep_coll_id}')
+    prep_coll = ee.FeatureCollection([
+        ee.Feature(ee.Geometry(ftr['geometry']), ftr['properties'])
+        for ftr in prep_info['features']
+    ])
+    task = ee.batch.Export.table.toAsset(
+        collection=prep_coll,
+        description=prep_coll_id.split('/')[-1],
+        assetId=prep_coll_id,
+    )
+    task.start()
+    print(f'Task: {task.id}')
+    print('Rerun with --validate after the task finishes so the extraction tools will use the asset')
+
+    return True
+
+
+def reference_counts(export_ws, model_name):
+    """Return the last extraction CSV path, its date, and its pixel count for each feature"""
+    model_ws = os.path.join(export_ws, model_name)
+    if os.path.isdir(model_ws):
+        csv_list = sorted(item for item in os.listdir(model_ws) if item.endswith('.csv'))
+    else:
+        csv_list = []
+    if not csv_list:
+        raise ValueError(f'no CSV files to validate against in {model_ws}')
+
+    csv_path = os.path.join(model_ws, csv_list[-1])
+    image_date = datetime.strptime(os.path.splitext(csv_list[-1])[0].split('_')[-1], '%Y%m%d')
+
+    csv_df = pd.read_csv(csv_path, dtype={FEATURE_ID_PROPERTY: str})
+    csv_df.rename(columns={'Pixel_Count': 'PIXEL_COUNT'}, inplace=True)
+    csv_counts = csv_df.set_index(FEATURE_ID_PROPERTY)['PIXEL_COUNT'].to_dict()
+
+    return csv_path, image_date, csv_counts
+
+
+def run_pixel_counts(input_list, project_id=PROJECT_ID, processes=20):
+    """Compute the pixel counts for each feature using a multiprocessing pool"""
+    with multiprocessing.Pool(
+            processes=processes,
+            initializer=ee_initializer,
+            initargs=(project_id, 'https://earthengine-highvolume.googleapis.com')
+    ) as p:
+        return p.starmap(pixel_count, input_list)
+
+
+def check_counts(ftr_ids, prep_counts, csv_counts):
+    """Print any pixel count mismatches and return True if there are none"""
+    mismatch_count = 0
+    for ftr_id, prep_count in zip(ftr_ids, prep_counts):
+        if ftr_id not in csv_counts:
+            print(f'  {ftr_id} - not in CSV, skipping')
+        elif prep_count != csv_counts[ftr_id]:
+            print(f'  {ftr_id} - pixel count mismatch ({prep_count} != {csv_counts[ftr_id]})')
+            mismatch_count += 1
+
+    if mismatch_count:
+        print(f'\n{mismatch_count} pixel count mismatches')
+        return False
+    print('Pixel counts match')
+    return True
+
+
+def ee_initializer(project_id=PROJECT_ID, opt_url='https://earthengine-highvolume.googleapis.com'):
+    ee.Initialize(project=project_id, opt_url=opt_url)
+
+
+def cimis_grid():
+    """Return the CIMIS export CRS, extent, and transform used by the extraction tools"""
+    # CIMIS Albers Equal Area Projection
+    # Using the EPSG:3310 code wasn't working, so pulling wkt from a CIMIS image
+    # Reduced the extent slightly from the default used for CIMIS
+    export_crs = ee.Image('projects/openet/assets/meteorology/cimis/ancillary/mask').projection().wkt()
+    export_extent = [-376010, -606000, 542010, 452010]
+    cellsize = 30
+    export_geo = [cellsize, 0, export_extent[0], 0, -cellsize, export_extent[3]]
+    return export_crs, export_extent, export_geo
+
+
+def pixel_count(
+        image_date,
+        model_coll_id,
+        et_band,
+        ftr_id,
+        feature_coll_id=None,
+        geometry=None,
+        mask_flag=False,
+):
+    """Count the model image pixels in a feature on the CIMIS grid
+
+    The feature geometry is either read from the feature collection
+    (the same way as the extraction tools) or built from a GeoJSON geometry.
+
+    """
+    export_crs, export_extent, export_geo = cimis_grid()
+
+    if geometry is not None:
+        geometry = ee.Geometry(geometry)
+    else:
+        geometry = (
+            ee.FeatureCollection(feature_coll_id)
+            .filterMetadata(FEATURE_ID_PROPERTY, 'equals', ftr_id)
+            .first()
+            .geometry()
+        )
+
+    image = (
+        ee.ImageCollection(model_coll_id)
+        .filterDate(image_date, ee.Date(image_date).advance(1, 'month'))
+        .select([et_band], ['et'])
+        .mosaic()
+    )
+    if mask_flag:
+        # Exclude urban pixels/polygons in the California statewide crop mapping data
+        ag_mask = ee.Image('projects/openet/assets/crop_type/california/2024')
+        image = image.updateMask(ag_mask.updateMask(ag_mask.neq(82)))
+
+    output_info = image.reduceRegion(
+        geometry=geometry,
+        reducer=ee.Reducer.count(),
+        crs=export_crs,
+        crsTransform=export_geo,
+        bestEffort=False,
+    ).getInfo()
+
+    return output_info['et']
+
+
+def _vertex_count(coordinates):
+    """Count the vertices in a (nested) GeoJSON coordinate list"""
+    if coordinates and isinstance(coordinates[0], (int, float)):
+        return 1
+    return sum(_vertex_count(c) for c in coordinates)
+
+
+def arg_parse():
+    """"""
+    parser = argparse.ArgumentParser(
+        description='Clip, simplify, and cache the groundwater basin geometries on the CIMIS grid',
+        formatter_class=argparse.ArgumentDefaultsHelpFormatter)
+    parser.add_argument(
+        '--lands', default='all_lands', choices=['all_lands', 'ag_lands'],
+        help='Extraction outputs to validate the pixel counts against')
+    parser.add_argument(
+        '--model', default='ENSEMBLE',
+        help='Model of the extraction outputs to validate the pixel counts against')
+    parser.add_argument(
+        '--tolerance', type=float, default=TOLERANCE,
+        help='Simplification tolerance (meters)')
+    parser.add_argument(
+        '--overwrite', default=False, action='store_true',
+        help='Rebuild the cached geometries and replace the asset')
+    parser.add_argument(
+        '--validate', default=False, action='store_true',
+        help='Validate the pixel counts of the uploaded asset and mark it as validated')
+    parser.add_argument(
+        '--mp', type=int, default=20,
+        help='Number of multiprocessing workers')
+    parser.add_argument(
+        '--project', default=PROJECT_ID,
+        help='Google cloud project ID to use for GEE authentication')
+    parser.add_argument(
+        '--debug', default=logging.INFO, const=logging.DEBUG,
+        help='Debug level logging', action='store_const', dest='loglevel')
+    args = parser.parse_args()
+
+    return args
+
+
+if __name__ == '__main__':
+    args = arg_parse()
+
+    logging.basicConfig(level=args.loglevel, format='%(message)s')
+
+    main(
+        lands=args.lands,
+        model_name=args.model,
+        tolerance=args.tolerance,
+        project_id=args.project,
+        overwrite_flag=args.overwrite,
+        validate_flag=args.validate,
+        processes=args.mp,
+    )
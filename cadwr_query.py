@@ -0,0 +1,341 @@
+import argparse
+import functools
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+import json
+import logging
+import math
+import os
+import threading
+from urllib.parse import parse_qs, urlparse
+
+import numpy as np
+
+LAND_TYPES = ['ag_lands', 'all_lands']
+MODELS = ['DISALEXI', 'EEMETRIC', 'GEESEBAL', 'PTJPL', 'SIMS', 'SSEBOP', 'ENSEMBLE']
+CACHE_SIZE = 1024
+RELOAD_SECONDS = 60
+
+
+def main(workspace=None, host='localhost', port=8000, cache_size=CACHE_SIZE,
+         reload_seconds=RELOAD_SECONDS):
+    """Serve the combined basin results from a local HTTP server
+
+    Parameters
+    ----------
+    workspace : str, optional
+        Folder containing the "csv_<land type>" folders (the default is the
+        current working directory).
+    host : str, optional
+    port : int, optional
+    cache_size : int, optional
+        The maximum number of query results to keep in the LRU cache.
+    reload_seconds : float, optional
+        How often to check for new combine outputs (in seconds).
+
+    """
+    basin_index = BasinIndex(workspace=workspace, cache_size=cache_size)
+    basin_index.start_reload_thread(reload_seconds)
+
+    handler = functools.partial(QueryHandler, basin_index=basin_index)
+    with ThreadingHTTPServer((host, port), handler) as server:
+        print(f'Serving on http://{host}:{port}')
+        try:
+            server.serve_forever()
+        except KeyboardInterrupt:
+            pass
+
+    print('\nDone')
+
+
+class BasinIndex:
+    """In-memory index of the combined basin x month model ET matrices
+
+    The "<land type>_<model>_matrix.npz" files written by cadwr_combine_csv.py
+    are loaded once and indexed by land type, model, Basin_Subb, and date,
+    so a query is a dictionary lookup and a slice of a single matrix row.
+
+    Parameters
+    ----------
+    workspace : str, optional
+        Folder containing the "csv_<land type>" folders (the default is the
+        current working directory).
+    cache_size : int, optional
+        The maximum number of query results to keep in the LRU cache.
+
+    """
+    def __init__(self, workspace=None, cache_size=CACHE_SIZE):
+        self.workspace = workspace or os.getcwd()
+        self.cache_size = cache_size
+        self._reload_lock = threading.Lock()
+        self._mtimes = {}
+        self._data = {}
+        self._cached = {}
+        self.reload()
+
+    def matrix_paths(self):
+        """Return the matrix file path for each (land type, model) that exists"""
+        matrix_paths = {}
+        for land_type in LAND_TYPES:
+            for model in MODELS:
+                matrix_path = os.path.join(
+                    self.workspace, f'csv_{land_type}', f'{land_type}_{model.lower()}_matrix.npz'
+                )
+                if os.path.isfile(matrix_path):
+                    matrix_paths[(land_type, model)] = matrix_path
+        return matrix_paths
+
+    def reload(self):
+        """Load any matrix files that are new or have changed since the last load
+
+        Returns
+        -------
+        bool : True if the index was updated
+
+        """
+        with self._reload_lock:
+            matrix_paths = self.matrix_paths()
+            mtimes = {key: os.path.getmtime(path) for key, path in matrix_paths.items()}
+            if mtimes == self._mtimes:
+                return False
+
+            data = {key: value for key, value in self._data.items() if key in mtimes}
+            for key, matrix_path in matrix_paths.items():
+                if mtimes[key] == self._mtimes.get(key):
+                    continue
+                logging.info(f'Loading {matrix_path}')
+                with np.load(matrix_path) as npz:
+                    data[key] = {
+                        'basin': {str(basin): i for i, basin in enumerate(npz['basin'])},
+                        'date': npz['date'],
+                        'et_mm': npz['et_mm'],
+                        'pixel_count': npz['pixel_count'],
+                    }
+
+            # Swap in the new data and an empty cache together so that a query
+            #   never sees cached results from the previous data
+            self._data, self._cached = data, {
+                'timeseries': functools.lru_cache(maxsize=self.cache_size)(
+                    functools.partial(_timeseries, data)),
+                'month': functools.lru_cache(maxsize=self.cache_size)(
+                    functools.partial(_month, data)),
+            }
+            self._mtimes = mtimes
+            return True
+
+    def start_reload_thread(self, reload_seconds=RELOAD_SECONDS):
+        """Check for new combine outputs in a background thread"""
+        stop_event = threading.Event()
+
+        def reload_loop():
+            while not stop_event.wait(reload_seconds):
+                try:
+                    self.reload()
+                except Exception as e:
+                    # Files may be partially written if the combine tool is running
+                    logging.warning(f'Reload failed, retrying: {e}')
+
+        threading.Thread(target=reload_loop, daemon=True).start()
+        return stop_event
+
+    def land_types(self):
+        return sorted(set(land_type for land_type, model in self._data.keys()))
+
+    def models(self, land_type):
+        return [model for model in MODELS if (land_type, model) in self._data]
+
+    def basins(self, land_type):
+        return sorted(set(
+            basin
+            for (lands, model), model_data in self._data.items() if lands == land_type
+            for basin in model_data['basin']
+        ))
+
+    def timeseries(self, land_type, model, basin, start_date=None, end_date=None):
+        """Return the monthly values for a basin in the (inclusive/exclusive) date range
+
+        Results are shared with the LRU cache and should not be modified.
+
+        Parameters
+        ----------
+        land_type : {'ag_lands', 'all_lands'}
+        model : str
+        basin : str
+            Basin_Subb value.
+        start_date : str, optional
+            Start date (in ISO format YYYY-MM-DD).
+        end_date : str, optional
+            End date (in ISO format YYYY-MM-DD).
+
+        Returns
+        -------
+        list of dict
+
+        Raises
+        ------
+        KeyError if the land type, model, or basin is not in the index.
+        ValueError if the dates are not valid.
+
+        """
+        return self._cached['timeseries'](land_type, model.upper(), basin, start_date, end_date)
+
+    def month(self, land_type, model, date):
+        """Return the values for all basins for a single month
+
+        Results are shared with the LRU cache and should not be modified.
+
+        """
+        return self._cached['month'](land_type, model.upper(), date)
+
+
+def _timeseries(data, land_type, model, basin, start_date=None, end_date=None):
+    """Uncached basin time series query (see BasinIndex.timeseries)"""
+    model_data = data[(land_type, model)]
+    row = model_data['basin'][basin]
+
+    # The date axis is sorted, so the range is found with a binary search
+    date_array = model_data['date']
+    start_i = 0 if not start_date else np.searchsorted(date_array, np.datetime64(start_date, 'D'))
+    end_i = len(date_array) if not end_date else np.searchsorted(date_array, np.datetime64(end_date, 'D'))
+
+    return [
+        dict(Date=str(date), **_values(et_mm, pixel_count))
+        for date, et_mm, pixel_count in zip(
+            date_array[start_i:end_i],
+            model_data['et_mm'][row, start_i:end_i].tolist(),
+            model_data['pixel_count'][row, start_i:end_i].tolist(),
+        )
+    ]
+
+
+def _month(data, land_type, model, date):
+    """Uncached single month query (see BasinIndex.month)"""
+    model_data = data[(land_type, model)]
+    col = np.searchsorted(model_data['date'], np.datetime64(date, 'D'))
+    if col >= len(model_data['date']) or model_data['date'][col] != np.datetime64(date, 'D'):
+        raise KeyError(date)
+
+    return [
+        dict(Basin_Subb=basin, **_values(et_mm, pixel_count))
+        for basin, et_mm, pixel_count in zip(
+            model_data['basin'].keys(),
+            model_data['et_mm'][:, col].tolist(),
+            model_data['pixel_count'][:, col].tolist(),
+        )
+    ]
+
+
+def _values(et_mm, pixel_count):
+    """Format the matrix values to match the combined CSV files"""
+    et_mm = None if math.isnan(et_mm) else round(et_mm, 4)
+    return {
+        'ET_MM': et_mm,
+        'ET_INCH': None if et_mm is None else round(et_mm / 25.4, 6),
+        'Pixel_Count': pixel_count,
+    }
+
+
+class QueryHandler(BaseHTTPRequestHandler):
+    """JSON query endpoints
+
+    /basins?lands=ag_lands
+    /timeseries?lands=ag_lands&model=ENSEMBLE&basin=5-022.01&start=2020-01-01&end=2021-01-01
+    /month?lands=ag_lands&model=ENSEMBLE&date=2020-07-01
+
+    """
+    def __init__(self, *args, basin_index=None, **kwargs):
+        self.basin_index = basin_index
+        super().__init__(*args, **kwargs)
+
+    # Required query parameters for each path
+    REQUIRED_PARAMS = {
+        '/basins': [],
+        '/timeseries': ['model', 'basin'],
+        '/month': ['model', 'date'],
+    }
+
+    def do_GET(self):
+        url = urlparse(self.path)
+        params = {k: v[0] for k, v in parse_qs(url.query).items()}
+        land_type = params.get('lands', 'ag_lands')
+
+        if url.path not in self.REQUIRED_PARAMS:
+            return self._send(404, {'error': f'unsupported path: {url.path}'})
+        missing = [p for p in self.REQUIRED_PARAMS[url.path] if not params.get(p)]
+        if missing:
+            return self._send(400, {'error': f'missing parameters: {", ".join(missing)}'})
+        if land_type not in self.basin_index.land_types():
+            return self._send(404, {'error': f'not found: {land_type!r}'})
+
+        try:
+            if url.path == '/basins':
+                output = {
+                    'lands': land_type,
+                    'models': self.basin_index.models(land_type),
+                    'basins': self.basin_index.basins(land_type),
+                }
+            elif url.path == '/timeseries':
+                output = self.basin_index.timeseries(
+                    land_type, params['model'], params['basin'],
+                    params.get('start'), params.get('end'),
+                )
+            elif url.path == '/month':
+                output = self.basin_index.month(land_type, params['model'], params['date'])
+        except KeyError as e:
+            return self._send(404, {'error': f'not found: {e}'})
+        except ValueError as e:
+            return self._send(400, {'error': str(e)})
+
+        self._send(200, output)
+
+    def _send(self, status, output):
+        body = json.dumps(output).encode('utf-8')
+        self.send_response(status)
+        self.send_header('Content-Type', 'application/json')
+        self.send_header('Content-Length', str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def log_message(self, format, *args):
+        logging.debug(format % args)
+
+
+def arg_parse():
+    """"""
+    parser = argparse.ArgumentParser(
+        description='Serve the combined California/CIMIS OpenET basin results',
+        formatter_class=argparse.ArgumentDefaultsHelpFormatter)
+    parser.add_argument(
+        '--workspace', default=os.getcwd(),
+        help='Folder containing the csv_ag_lands and csv_all_lands folders')
+    parser.add_argument(
+        '--host', default='localhost',
+        help='Server host name')
+    parser.add_argument(
+        '--port', type=int, default=8000,
+        help='Server port')
+    parser.add_argument(
+        '--cache', type=int, default=CACHE_SIZE,
+        help='Maximum number of query results to cache')
+    parser.add_argument(
+        '--reload', type=float, default=RELOAD_SECONDS,
+        help='Seconds between checks for new combine outputs')
+    parser.add_argument(
+        '--debug', default=logging.INFO, const=logging.DEBUG,
+        help='Debug level logging', action='store_const', dest='loglevel')
+    args = parser.parse_args()
+
+    return args
+
+
+if __name__ == '__main__':
+    args = arg_parse()
+
+    logging.basicConfig(level=args.loglevel, format='%(message)s')
+
+    main(
+        workspace=args.workspace,
+        host=args.host,
+        port=args.port,
+        cache_size=args.cache,
+        reload_seconds=args.reload,
+    )